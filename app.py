@@ -1,10 +1,51 @@
 import streamlit as st
-import ollama
 import json
+import logging
+import orjson
+import msgpack
 import os
+import tempfile
 import hashlib
-from time import sleep
+import threading
+from time import monotonic
 import datetime
+from charset_normalizer import from_bytes
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Configure only this app's logger; the root logger (httpx, etc.) belongs to the Streamlit server
+logger = logging.getLogger(__name__)
+if not logger.handlers:  # The script is re-executed on every rerun; attach the handler once
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+MODEL_LIST_TTL = 60  # Seconds the Ollama model list is cached across reruns and sessions
+RESPONSE_CACHE_SIZE = 64  # Max cached (model, file, system prompt, prompt, history) -> response entries
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant."
+DEFAULT_SYSTEM_MESSAGE = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}  # Shared; never mutate in place
+DEFAULT_SYSTEM_MESSAGE_HASH = hashlib.sha256(DEFAULT_SYSTEM_PROMPT.encode()).hexdigest()
+CONTEXT_PROMPT_TEMPLATE = (
+    DEFAULT_SYSTEM_PROMPT + "\n\nUse the following document summary and context if relevant:\n"
+    "**Summary**: {summary}\n"
+    "**Full Context**:\n---CONTEXT START---\n{content}\n---CONTEXT END---"
+)
+SUMMARY_PROMPT_TEMPLATE = (
+    DEFAULT_SYSTEM_PROMPT + "\n\nUse the following document summary if relevant:\n"
+    "**Summary**: {summary}"
+)
+STREAM_FLUSH_INTERVAL = 0.15  # Max seconds between UI updates while streaming a response
+STREAM_FLUSH_CHUNKS = 8  # ...or flush once this many chunks are buffered
+HISTORY_TURNS = 8  # Prior user/assistant turns sent to the model with each prompt
+CACHE_FILE = "document_cache.msgpack"
+LEGACY_CACHE_FILE = "document_cache.json"  # Pre-msgpack cache, migrated on first load
+CACHE_BLOB_DIR = "cache_blobs"  # Document bodies, stored once per content hash as <sha256>.txt
+OLLAMA_KEEP_ALIVE = "60m"  # Keep the model (and its prompt KV cache) loaded between turns
+SUMMARY_INPUT_CHARS = 2000  # Leading characters of a document sent for summarization (token limit)
+SUMMARY_WORKERS = 4  # Concurrent summary requests; Ollama serves up to OLLAMA_NUM_PARALLEL at once
 
 # --- Session State Initialization ---
 def initialize_session():
@@ -12,117 +53,364 @@ def initialize_session():
     defaults = {
         "messages": [],
         "file_content": "",
-        "uploaded_file_obj": None,
-        "available_models": [],
+        "uploaded_file_ids": (),  # file_ids of the uploads currently providing context
+        "available_models": (),
+        "model_index": {},  # {model_name: selectbox option index}
         "selected_model": None,
         "models_loaded": False,
         "ollama_error": None,
-        "document_cache": {},  # {file_hash: {"content": str, "summary": str, "timestamp": str, "filename": str}}
+        "document_cache": {},  # {file_hash: {"summary": str, "timestamp": str, "filename": str, "encoding": str}}
+        "cache_dirty": False,  # True when document_cache has changes not yet written to disk
+        "active_file_hashes": [],  # SHA-256 of each active context file, in upload order
+        "upload_hashes": {},  # {UploadedFile.file_id: file_hash}, so each upload is hashed at most once
+        "file_hash": "",  # Key for the active context as a whole (the file's hash when there is one), "" when none
+        "system_message": DEFAULT_SYSTEM_MESSAGE,  # Summary + full context; built once per file load / summary change
+        "summary_system_message": DEFAULT_SYSTEM_MESSAGE,  # Summary only; sent once the full body has been sent
+        "system_message_hash": DEFAULT_SYSTEM_MESSAGE_HASH,  # SHA-256 of system_message["content"]
+        "summary_system_message_hash": DEFAULT_SYSTEM_MESSAGE_HASH,  # SHA-256 of summary_system_message["content"]
+        "include_full_context": False,  # Sidebar checkbox: send the full document on every turn
+        "full_context_sent_for": "",  # file_hash of the context whose full body the model last received
+        "summaries_ready": True,  # False while any active document lacks a usable summary
+        "response_cache": OrderedDict(),  # {(model, file_hash, system_hash, prompt, history_hash): response}
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
 
 # --- Ollama Interaction ---
+@st.cache_data(ttl=MODEL_LIST_TTL, show_spinner=False)
+def _fetch_model_names():
+    """Fetches the sorted model names from Ollama as an immutable tuple, cached across reruns."""
+    import ollama  # Deferred: pulls in httpx/pydantic, not needed until Ollama is contacted
+
+    models_data = ollama.list()
+    logger.debug("ollama.list() raw response: %r", models_data)
+
+    if not (hasattr(models_data, 'models') and isinstance(models_data.models, list)):
+        logger.error("Expected response object with a 'models' attribute containing a list. Received type: %s", type(models_data))
+        return ()
+
+    valid_model_names = [
+        item.model for item in models_data.models
+        if hasattr(item, 'model') and isinstance(getattr(item, 'model', None), str)
+    ]
+    valid_model_names.sort()
+    if not valid_model_names:
+        logger.warning("Parsing completed, but resulted in empty model list. Raw models: %r", models_data.models)
+    return tuple(valid_model_names)
+
 def get_ollama_models():
-    """Fetches the list of models from Ollama, logs raw output, and updates session state."""
+    """Loads the (cached) list of Ollama models and updates session state."""
     st.session_state.ollama_error = None
-    print("--- Attempting to fetch Ollama models... ---")
+    logger.info("Attempting to fetch Ollama models...")
     try:
-        models_data = ollama.list()
-        print("--- ollama.list() raw response START ---")
-        print(repr(models_data))
-        print("--- ollama.list() raw response END ---")
-
-        if hasattr(models_data, 'models') and isinstance(models_data.models, list):
-            model_list = models_data.models
-            valid_model_names = sorted([
-                item.model for item in model_list
-                if hasattr(item, 'model') and isinstance(getattr(item, 'model', None), str)
-            ])
-            st.session_state.available_models = valid_model_names
-            print(f"--- Extracted model names: {valid_model_names} ---")
-        else:
-            print(f"--- ERROR: Expected response object with a 'models' attribute containing a list. Received type: {type(models_data)} ---")
-            st.session_state.available_models = []
+        valid_model_names = _fetch_model_names()
+        st.session_state.available_models = valid_model_names
+        st.session_state.model_index = {name: i + 1 for i, name in enumerate(valid_model_names)}
+        logger.debug("Extracted model names: %s", valid_model_names)
 
         st.session_state.models_loaded = True
 
         if not st.session_state.available_models:
             error_msg = "Ollama is running, but no valid models were extracted. Check terminal logs."
-            print(f"--- Parsing completed, but resulted in empty model list. Raw models: {getattr(models_data, 'models', 'Attribute not found')} ---")
             st.session_state.ollama_error = error_msg
             return False
         else:
             st.session_state.ollama_error = None
-            print("--- Models successfully loaded into session state. ---")
+            logger.info("%d models successfully loaded into session state.", len(valid_model_names))
             return True
 
     except Exception as e:
         error_msg = f"Could not connect to Ollama or list models: {e}. Ensure Ollama is running."
         st.error(error_msg)
-        print(f"--- Exception during ollama.list(): {type(e).__name__} - {e} ---")
-        st.session_state.available_models = []
+        logger.error("Exception during ollama.list(): %s - %s", type(e).__name__, e)
+        st.session_state.available_models = ()
+        st.session_state.model_index = {}
         st.session_state.selected_model = None
         st.session_state.models_loaded = True
         st.session_state.ollama_error = f"Connection/List Error: {e}"
         return False
 
+def stream_chat_tokens(model, messages, received):
+    """Streams a chat completion from Ollama, coalescing tokens into one yield per flush interval or chunk batch.
+
+    Every yielded piece is also appended to `received`, so the caller still has the partial
+    answer if the script run is stopped mid-stream.
+
+    Closing this generator early (Cancel button, script run stopped) closes the underlying HTTP
+    stream, so Ollama stops generating instead of finishing an answer nobody will read.
+    """
+    import ollama
+
+    stream = ollama.chat(
+        model=model,
+        messages=messages,
+        stream=True,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+    )
+    try:
+        parts = []
+        last_flush = monotonic()
+        for chunk in stream:
+            # Avoid allocating a fallback {} per chunk in this hot loop
+            msg = chunk.get('message')
+            chunk_content = msg['content'] if msg and 'content' in msg else ''
+            if chunk_content:
+                parts.append(chunk_content)
+                if len(parts) >= STREAM_FLUSH_CHUNKS or monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                    piece = "".join(parts)
+                    received.append(piece)
+                    yield piece
+                    parts.clear()
+                    last_flush = monotonic()
+        if parts:
+            piece = "".join(parts)
+            received.append(piece)
+            yield piece
+    finally:
+        stream.close()
+
 # --- Helper Function: Generate File Hash ---
-def get_file_hash(file_bytes):
-    """Generates a SHA-256 hash of the file content for cache key."""
-    return hashlib.sha256(file_bytes).hexdigest()
+def get_file_hash(uploaded_file):
+    """Generates a SHA-256 hash of an uploaded file for cache key, memoized by the upload's file_id."""
+    file_hash = st.session_state.upload_hashes.get(uploaded_file.file_id)
+    if file_hash is None:
+        # UploadedFile is a BytesIO: hash its buffer in place, independent of the read position
+        with uploaded_file.getbuffer() as view:
+            file_hash = hashlib.sha256(view).hexdigest()
+        st.session_state.upload_hashes[uploaded_file.file_id] = file_hash
+    return file_hash
+
+# --- Helper Function: Decode Upload ---
+def decode_upload(uploaded_file):
+    """Decodes an uploaded file, returning (content, encoding) or (None, None) if no encoding fits.
+
+    UTF-8 (with or without BOM) is decoded straight from the upload's in-memory buffer in a single
+    C-level pass; only non-UTF-8 files pay for a bytes copy and charset-normalizer's detection.
+    """
+    with uploaded_file.getbuffer() as view:
+        try:
+            return str(view, "utf-8-sig"), "UTF-8"
+        except UnicodeDecodeError as e:
+            logger.info("Not UTF-8 (invalid byte at offset %d), detecting encoding", e.start)
+        detected = from_bytes(bytes(view)).best()
+    if detected is None:
+        return None, None
+    return str(detected), detected.encoding.upper()
 
 # --- Helper Function: Summarize Document ---
+@st.cache_data(show_spinner=False, max_entries=128)
+def _summarize_cached(head_hash, model, _head):
+    """Asks the model for a summary of a document's leading text, cached per (head_hash, model).
+
+    The leading underscore keeps _head out of Streamlit's cache key, so the text is never hashed here.
+    """
+    import ollama
+
+    prompt = (
+        "Summarize the following document in 2-3 sentences, capturing the main points:\n\n"
+        f"{_head}"
+    )
+    logger.info("Summarizing document with model %s", model)
+    logger.debug("Summary input (first 100 chars): %.100s...", _head)
+    response = ollama.chat(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=False,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+    )
+    summary = response.get("message", {}).get("content", "").strip()
+    if not summary:
+        # Raised rather than returned, so st.cache_data does not keep the empty result
+        raise ValueError("Empty response.")
+    return summary
+
 def summarize_document(content, model):
     """Uses the selected model to generate a summary of the document."""
     if not model:
-        print("--- No model selected for summarization ---")
+        logger.info("No model selected for summarization")
         return "Summary pending: Select a model to generate."
     try:
-        prompt = (
-            "Summarize the following document in 2-3 sentences, capturing the main points:\n\n"
-            f"{content[:2000]}"  # Limit input to avoid token limits
-        )
-        print(f"--- Summarizing document with model {model} (first 100 chars): {content[:100]}... ---")
-        response = ollama.chat(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            stream=False,
-        )
-        summary = response.get("message", {}).get("content", "")
-        if not summary:
-            print("--- Summary empty or not found in response ---")
-            return "Summary could not be generated: Empty response."
-        print(f"--- Generated summary: {summary[:100]}... ---")
-        return summary.strip()
+        # Only the head is summarized, so it alone is hashed and held by the cache
+        head = content[:SUMMARY_INPUT_CHARS]
+        summary = _summarize_cached(hashlib.sha256(head.encode()).hexdigest(), model, head)
+        logger.debug("Generated summary: %.100s...", summary)
+        return summary
     except Exception as e:
-        print(f"--- Error summarizing document: {type(e).__name__} - {e} ---")
+        # Exceptions are not cached by st.cache_data, so a failed summary is retried next time
+        logger.error("Error summarizing document: %s - %s", type(e).__name__, e)
         return f"Summary could not be generated: {str(e)}"
 
+def is_usable_summary(summary):
+    """Returns True if summary is a real summary, not empty, pending or a failure notice."""
+    return bool(summary) and not summary.startswith(("Summary pending", "Summary could not be generated"))
+
+def summarize_documents(contents, model):
+    """Summarizes several documents concurrently, returning summaries in the same order."""
+    if len(contents) <= 1:
+        return [summarize_document(content, model) for content in contents]
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=SUMMARY_WORKERS,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as executor:
+        return list(executor.map(lambda content: summarize_document(content, model), contents))
+
+# --- Helper Function: Build System Prompt ---
+def build_system_prompt(content, summary, include_content=True):
+    """Formats the system prompt for the given context file content and summary.
+
+    Each variant (full context or summary only) is byte-identical for a given file and summary, so
+    Ollama can reuse its prompt prefix cache while the same variant is sent: never interpolate
+    per-turn values (timestamps, counters) into it. The chat path deliberately switches from the
+    full variant to the summary-only one after the document has been sent once.
+    """
+    if not content:
+        return DEFAULT_SYSTEM_PROMPT
+    if not include_content:
+        return SUMMARY_PROMPT_TEMPLATE.format(summary=summary)
+    return CONTEXT_PROMPT_TEMPLATE.format(summary=summary, content=content)
+
+def build_system_message(content, summary, include_content=True):
+    """Builds the system message sent ahead of the chat history; reused unchanged for every turn."""
+    if not content:
+        return DEFAULT_SYSTEM_MESSAGE
+    return {"role": "system", "content": build_system_prompt(content, summary, include_content)}
+
+def set_system_messages(content, summary):
+    """Stores the full-context and summary-only system messages, and their hashes, in session state."""
+    st.session_state.system_message = build_system_message(content, summary)
+    st.session_state.summary_system_message = build_system_message(content, summary, include_content=False)
+    # Hashed once here so response cache keys can tell the variants apart without rehashing per turn
+    st.session_state.system_message_hash = hashlib.sha256(
+        st.session_state.system_message["content"].encode()
+    ).hexdigest()
+    st.session_state.summary_system_message_hash = hashlib.sha256(
+        st.session_state.summary_system_message["content"].encode()
+    ).hexdigest()
+
+def clear_file_context():
+    """Drops the active context files and falls back to the default system prompt."""
+    st.session_state.active_file_hashes = []
+    st.session_state.file_hash = ""
+    st.session_state.file_content = ""
+    st.session_state.summaries_ready = True
+    set_system_messages("", "")
+
+def load_active_context():
+    """Combines the active documents' bodies and summaries into the file context and system messages."""
+    file_hashes = st.session_state.active_file_hashes
+    if not file_hashes:
+        clear_file_context()
+        return
+    docs = [(st.session_state.document_cache[file_hash], get_content(file_hash)) for file_hash in file_hashes]
+    if len(docs) == 1:
+        (data, content), = docs
+        summary = data["summary"]
+        st.session_state.file_hash = file_hashes[0]
+    else:
+        content = "\n\n".join(f"### {data['filename']}\n{body}" for data, body in docs)
+        summary = "\n".join(f"- {data['filename']}: {data['summary']}" for data, _ in docs)
+        st.session_state.file_hash = hashlib.sha256("".join(file_hashes).encode()).hexdigest()
+    st.session_state.file_content = content
+    st.session_state.summaries_ready = all(is_usable_summary(data["summary"]) for data, _ in docs)
+    set_system_messages(content, summary)
+
+# --- Helper Functions: Response Cache ---
+def get_response_cache_key(model, file_hash, system_hash, prompt, history):
+    """Builds the response cache key from the model, context file, system message sent, prompt and prior history."""
+    history_hash = hashlib.sha256(json.dumps(history).encode()).hexdigest()
+    return (model, file_hash, system_hash, prompt, history_hash)
+
+def store_cached_response(key, response):
+    """Stores a response in the bounded LRU response cache, evicting the oldest entry when full."""
+    cache = st.session_state.response_cache
+    cache[key] = response
+    cache.move_to_end(key)
+    while len(cache) > RESPONSE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+# --- Helper Functions: Content Blobs ---
+def write_file_atomic(path, data):
+    """Writes bytes to path via a unique temp file in the same directory, so concurrent writers never clash."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_blob_path(file_hash):
+    """Returns the path of the content-addressed blob holding a document body."""
+    return os.path.join(CACHE_BLOB_DIR, f"{file_hash}.txt")
+
+def save_content_blob(file_hash, content):
+    """Writes a document body to its blob file; bodies are immutable per hash, so existing blobs are kept."""
+    blob_path = get_blob_path(file_hash)
+    if os.path.exists(blob_path):
+        return
+    os.makedirs(CACHE_BLOB_DIR, exist_ok=True)
+    try:
+        write_file_atomic(blob_path, content.encode("utf-8"))
+    except OSError:
+        # Another session may have written the same body first (e.g. replace refused on Windows); that counts
+        if not os.path.exists(blob_path):
+            raise
+    logger.debug("Wrote content blob %s (len: %d)", blob_path, len(content))
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_content(file_hash):
+    """Lazily reads a document body from its blob file, keeping the most recently used bodies in memory."""
+    with open(get_blob_path(file_hash), "rb") as f:
+        return f.read().decode("utf-8")
+
 # --- Helper Function: Load/Save Cache to Disk ---
 def save_cache_to_disk():
-    """Saves the document cache to a JSON file."""
+    """Atomically saves the document cache to a msgpack file, skipping the write if nothing changed."""
+    if not st.session_state.cache_dirty:
+        logger.debug("Cache unchanged, skipping save")
+        return
     try:
-        print(f"--- Saving cache to document_cache.json: {len(st.session_state.document_cache)} entries ---")
-        for file_hash, data in st.session_state.document_cache.items():
-            print(f"--- Cache entry {file_hash}: filename={data['filename']}, content_len={len(data['content'])}, summary_len={len(data['summary'])} ---")
-        with open("document_cache.json", "w") as f:
-            json.dump(st.session_state.document_cache, f, indent=2)
+        logger.info("Saving cache to %s: %d entries", CACHE_FILE, len(st.session_state.document_cache))
+        if logger.isEnabledFor(logging.DEBUG):
+            for file_hash, data in st.session_state.document_cache.items():
+                logger.debug("Cache entry %s: filename=%s, summary_len=%d", file_hash, data['filename'], len(data['summary']))
+        write_file_atomic(CACHE_FILE, msgpack.packb(st.session_state.document_cache, use_bin_type=True))
+        st.session_state.cache_dirty = False
     except Exception as e:
-        print(f"--- Error saving cache to disk: {type(e).__name__} - {e} ---")
+        logger.error("Error saving cache to disk: %s - %s", type(e).__name__, e)
 
 def load_cache_from_disk():
-    """Loads the document cache from a JSON file if it exists."""
+    """Loads the document cache from its msgpack file, migrating a legacy JSON cache if that is all there is."""
     try:
-        if os.path.exists("document_cache.json"):
-            with open("document_cache.json", "r") as f:
-                st.session_state.document_cache = json.load(f)
-            print(f"--- Loaded cache from document_cache.json: {len(st.session_state.document_cache)} entries ---")
+        if os.path.exists(CACHE_FILE):
+            with open(CACHE_FILE, "rb") as f:
+                st.session_state.document_cache = msgpack.unpackb(f.read(), raw=False)
+            logger.debug("Loaded cache from %s: %d entries", CACHE_FILE, len(st.session_state.document_cache))
+        elif os.path.exists(LEGACY_CACHE_FILE):
+            with open(LEGACY_CACHE_FILE, "rb") as f:
+                st.session_state.document_cache = orjson.loads(f.read())
+            # Migrate entries written before bodies moved out of the cache file
+            for file_hash, data in st.session_state.document_cache.items():
+                if "content" in data:
+                    save_content_blob(file_hash, data.pop("content"))
+                    data.setdefault("encoding", "UTF-8")
+            st.session_state.cache_dirty = True
+            save_cache_to_disk()
+            logger.info("Migrated %s to %s: %d entries", LEGACY_CACHE_FILE, CACHE_FILE, len(st.session_state.document_cache))
         else:
-            print("--- No document_cache.json found ---")
+            logger.debug("No %s found", CACHE_FILE)
     except Exception as e:
-        print(f"--- Error loading cache from disk: {type(e).__name__} - {e} ---")
+        logger.error("Error loading cache from disk: %s - %s", type(e).__name__, e)
+
+# --- Helper Function: Render Chat History ---
+def render_history():
+    """Renders the chat history."""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
 # --- Application Start ---
 initialize_session()
@@ -135,6 +423,10 @@ load_cache_from_disk()
 with st.sidebar:
     st.header("Configuration")
 
+    if st.button("Refresh models"):
+        _fetch_model_names.clear()
+        st.session_state.models_loaded = False
+
     if not st.session_state.models_loaded:
         with st.spinner("Connecting to Ollama and fetching models..."):
             get_ollama_models()
@@ -147,13 +439,9 @@ with st.sidebar:
         st.success(f"Ollama connected. {len(st.session_state.available_models)} models available.")
 
     if st.session_state.available_models:
-        options = ["--- Select a Model ---"] + st.session_state.available_models
-        current_selection = st.session_state.selected_model
-        try:
-            index = options.index(current_selection) if current_selection else 0
-        except ValueError:
-            index = 0
-        selected = st.selectbox(
+        options = ("--- Select a Model ---", *st.session_state.available_models)
+        index = st.session_state.model_index.get(st.session_state.selected_model, 0)
+        st.selectbox(
             "Select LLM Model:",
             options=options,
             key="selected_model_widget",
@@ -165,103 +453,126 @@ with st.sidebar:
                 st.session_state.selected_model = None
         elif widget_value != st.session_state.selected_model:
             st.session_state.selected_model = widget_value
-            # Check if a summary is pending for the current file
-            if st.session_state.file_content and st.session_state.uploaded_file_obj:
-                file_hash = get_file_hash(st.session_state.uploaded_file_obj.read())
-                if file_hash in st.session_state.document_cache:
-                    if st.session_state.document_cache[file_hash]["summary"].startswith("Summary pending"):
-                        with st.spinner("Generating document summary..."):
-                            summary = summarize_document(
-                                st.session_state.file_content, st.session_state.selected_model
-                            )
-                            st.session_state.document_cache[file_hash]["summary"] = summary
-                            save_cache_to_disk()
-                            st.success("Summary generated for cached document!")
+            # Check if summaries are pending for the current files (direct lookup by recorded hash)
+            pending_hashes = [
+                file_hash for file_hash in st.session_state.active_file_hashes
+                if st.session_state.document_cache.get(file_hash, {}).get("summary", "").startswith("Summary pending")
+            ]
+            if pending_hashes:
+                with st.spinner("Generating document summary..."):
+                    summaries = summarize_documents(
+                        [get_content(file_hash) for file_hash in pending_hashes], st.session_state.selected_model
+                    )
+                    for file_hash, summary in zip(pending_hashes, summaries):
+                        st.session_state.document_cache[file_hash]["summary"] = summary
+                    st.session_state.cache_dirty = True
+                    load_active_context()
+                    save_cache_to_disk()
+                    st.success("Summary generated for cached document!")
     else:
         st.selectbox("Select LLM Model:", options=["--- Models Loading/Unavailable ---"], disabled=True)
 
     # --- File Uploader (Optional Context) ---
-    st.header("Optional Context File")
-    uploaded_file = st.file_uploader(
-        "Upload a text file for context",
+    st.header("Optional Context Files")
+    uploaded_files = st.file_uploader(
+        "Upload text files for context",
         type=None,
+        accept_multiple_files=True,
         key="file_uploader_widget"
     )
+    uploaded_file_ids = tuple(uploaded_file.file_id for uploaded_file in uploaded_files)
 
-    # Process file only if it's a new upload
-    if uploaded_file is not None and uploaded_file != st.session_state.uploaded_file_obj:
-        st.session_state.uploaded_file_obj = uploaded_file
+    # Process files only if the set of uploads changed
+    if uploaded_files and uploaded_file_ids != st.session_state.uploaded_file_ids:
         try:
-            file_bytes = uploaded_file.read()
-            file_hash = get_file_hash(file_bytes)
-            print(f"--- Processing uploaded file: {uploaded_file.name}, hash: {file_hash} ---")
-
-            # Check if file is already in cache
-            if file_hash in st.session_state.document_cache:
-                st.session_state.file_content = st.session_state.document_cache[file_hash]["content"]
-                print(f"--- Loaded cached content (len: {len(st.session_state.file_content)}) for {uploaded_file.name} ---")
-                st.success("Loaded cached document content and summary!")
-            else:
-                # Decode file
-                try:
-                    st.session_state.file_content = file_bytes.decode("utf-8")
-                    encoding = "UTF-8"
-                except UnicodeDecodeError:
-                    try:
-                        st.session_state.file_content = file_bytes.decode("latin-1")
-                        encoding = "Latin-1"
-                    except UnicodeDecodeError:
-                        st.error("Failed to decode file. Use plain text (UTF-8 or Latin-1).")
-                        st.session_state.file_content = ""
-                        st.session_state.uploaded_file_obj = None
-                        print("--- File decode failed ---")
-                        st.stop()
-
-                print(f"--- Decoded file content (len: {len(st.session_state.file_content)}): {st.session_state.file_content[:100]}... ---")
-
-                # Generate summary if model is selected
-                summary = ""
-                if st.session_state.selected_model:
-                    with st.spinner("Generating document summary..."):
-                        summary = summarize_document(st.session_state.file_content, st.session_state.selected_model)
-                else:
-                    summary = "Summary pending: Select a model to generate."
-
-                # Store in cache
+            file_hashes = []
+            uncached = []  # (file_hash, content) of new documents that still need a summary
+            for uploaded_file in uploaded_files:
+                # Hash first so repeat uploads skip decoding and summarizing entirely
+                file_hash = get_file_hash(uploaded_file)
+                logger.info("Processing uploaded file: %s, hash: %s", uploaded_file.name, file_hash)
+                if file_hash in file_hashes:
+                    continue
+
+                # Check if file is already in cache (an empty summary means an earlier run was interrupted)
+                cached_doc = st.session_state.document_cache.get(file_hash)
+                if cached_doc and cached_doc["summary"] and os.path.exists(get_blob_path(file_hash)):
+                    file_hashes.append(file_hash)
+                    logger.info("Loaded cached content for %s", uploaded_file.name)
+                    continue
+
+                content, encoding = decode_upload(uploaded_file)
+                if content is None:
+                    st.error(f"Failed to decode {uploaded_file.name}. Use a plain text file.")
+                    logger.error("File decode failed for %s: no encoding detected", uploaded_file.name)
+                    continue
+                logger.debug("Decoded file content (len: %d): %.100s...", len(content), content)
+
+                # Store in cache: body as a blob, metadata in the index; summary filled in below
+                save_content_blob(file_hash, content)
                 st.session_state.document_cache[file_hash] = {
-                    "content": st.session_state.file_content,
-                    "summary": summary,
+                    "summary": "",
                     "timestamp": datetime.datetime.now().isoformat(),
                     "filename": uploaded_file.name,
+                    "encoding": encoding,
                 }
-                print(f"--- Stored in cache: filename={uploaded_file.name}, content_len={len(st.session_state.file_content)}, summary_len={len(summary)} ---")
+                st.session_state.cache_dirty = True
+                file_hashes.append(file_hash)
+                uncached.append((file_hash, content))
+
+            # Generate summaries (concurrently) if a model is selected, otherwise mark them pending
+            if uncached:
+                with st.spinner("Generating document summary..."):
+                    summaries = summarize_documents(
+                        [content for _, content in uncached], st.session_state.selected_model
+                    )
+                for (file_hash, content), summary in zip(uncached, summaries):
+                    st.session_state.document_cache[file_hash]["summary"] = summary
+                    logger.info("Stored in cache: hash=%s, content_len=%d, summary_len=%d", file_hash, len(content), len(summary))
                 save_cache_to_disk()
-                st.success(f"{encoding} file context loaded! Summary {'generated' if st.session_state.selected_model else 'pending'}.")
+
+            st.session_state.active_file_hashes = file_hashes
+            load_active_context()
+            # Recorded only once the context is loaded, so an interrupted run processes these uploads again
+            st.session_state.uploaded_file_ids = uploaded_file_ids
+            if file_hashes:
+                st.success(
+                    f"{len(file_hashes)} context file(s) loaded ({len(file_hashes) - len(uncached)} from cache)! "
+                    f"Summary {'generated' if st.session_state.selected_model or not uncached else 'pending'}."
+                )
 
         except Exception as e:
             st.error(f"Error processing file: {e}")
-            st.session_state.file_content = ""
-            st.session_state.uploaded_file_obj = None
-            print(f"--- File processing error: {type(e).__name__} - {e} ---")
+            clear_file_context()
+            st.session_state.uploaded_file_ids = ()
+            logger.error("File processing error: %s - %s", type(e).__name__, e)
 
-    elif uploaded_file is None and st.session_state.uploaded_file_obj is not None:
-        st.session_state.uploaded_file_obj = None
-        st.session_state.file_content = ""
+    elif not uploaded_files and st.session_state.uploaded_file_ids:
+        st.session_state.uploaded_file_ids = ()
+        clear_file_context()
         st.info("File context removed.")
-        print("--- File context removed ---")
+        logger.info("File context removed")
+
+    st.checkbox(
+        "Include full document context each turn",
+        key="include_full_context",
+        help="Off: the full document is sent once per set of context files; later turns get its summary "
+        "(the full document keeps being sent until every summary is available).",
+    )
 
     # Display context status
     if st.session_state.file_content:
-        st.sidebar.success("Context file is active.")
-        # Display content length and summary
+        st.sidebar.success(f"{len(st.session_state.active_file_hashes)} context file(s) active.")
+        # Display content length and summaries
         content_len = len(st.session_state.file_content)
         st.sidebar.markdown(f"**Content Length**: {content_len} characters")
-        for file_hash, data in st.session_state.document_cache.items():
-            if data["content"] == st.session_state.file_content:
-                st.sidebar.markdown(f"**Document Summary**: {data['summary']}")
-                st.sidebar.markdown(f"**Filename**: {data['filename']}")
-                st.sidebar.markdown(f"**Cached**: {data['timestamp']}")
-                break
+        for file_hash in st.session_state.active_file_hashes:
+            data = st.session_state.document_cache.get(file_hash)
+            if not data:
+                continue
+            st.sidebar.markdown(f"**Filename**: {data['filename']}")
+            st.sidebar.markdown(f"**Document Summary**: {data['summary']}")
+            st.sidebar.markdown(f"**Cached**: {data['timestamp']}")
     else:
         st.sidebar.info("No context file loaded.")
 
@@ -274,9 +585,7 @@ with st.sidebar:
 st.header("Chat History")
 chat_container = st.container()
 with chat_container:
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    render_history()
 
 # --- Chat Input and Processing ---
 prompt = st.chat_input("Select a model, then ask a question...")
@@ -289,49 +598,77 @@ if prompt:
         st.markdown(prompt)
     st.session_state.messages.append({"role": "user", "content": prompt})
 
-    # Prepare context for the model
-    full_context = st.session_state.messages[:]
-    system_prompt_content = "You are a helpful AI assistant."
-    if st.session_state.file_content:
-        for file_hash, data in st.session_state.document_cache.items():
-            if data["content"] == st.session_state.file_content:
-                system_prompt_content += (
-                    f"\n\nUse the following document summary and context if relevant:\n"
-                    f"**Summary**: {data['summary']}\n"
-                    f"**Full Context**:\n---CONTEXT START---\n{st.session_state.file_content}\n---CONTEXT END---"
-                )
-                break
-        else:
-            system_prompt_content += (
-                f"\n\nUse the following text as context if relevant:\n"
-                f"---CONTEXT START---\n{st.session_state.file_content}\n---CONTEXT END---"
-            )
-
-    full_context.insert(0, {"role": "system", "content": system_prompt_content})
+    # Prepare context for the model: always [system, *history, user] so the prefix stays cache-eligible
+    # Only the last HISTORY_TURNS turns plus the new prompt are sent; older turns rely on the file context
+    recent_messages = st.session_state.messages[-(2 * HISTORY_TURNS + 1):]
+    # The full document goes out on the first turn after the file set changes, and on every turn while a
+    # summary is missing or failed; later turns carry only the summaries unless the user opts in
+    sends_full_context = (
+        st.session_state.include_full_context
+        or not st.session_state.summaries_ready
+        or st.session_state.full_context_sent_for != st.session_state.file_hash
+    )
+    if sends_full_context:
+        system_message = st.session_state.system_message
+        system_hash = st.session_state.system_message_hash
+    else:
+        system_message = st.session_state.summary_system_message
+        system_hash = st.session_state.summary_system_message_hash
+    full_context = [system_message, *recent_messages]  # One allocation, no shift
+
+    cache_key = get_response_cache_key(
+        st.session_state.selected_model,
+        st.session_state.file_hash,
+        system_hash,
+        prompt,
+        recent_messages[:-1],
+    )
 
     try:
         with st.chat_message("assistant"):
-            response_placeholder = st.empty()
-            full_response = ""
-            stream = ollama.chat(
-                model=st.session_state.selected_model,
-                messages=full_context,
-                stream=True,
-            )
-            for chunk in stream:
-                chunk_content = chunk.get('message', {}).get('content', '')
-                if chunk_content:
-                    full_response += chunk_content
-                    response_placeholder.markdown(full_response + "▌")
-            response_placeholder.markdown(full_response)
+            cached_response = st.session_state.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.info("Response cache hit, skipping Ollama call")
+                st.session_state.response_cache.move_to_end(cache_key)
+                full_response = cached_response
+                st.markdown(full_response)
+            else:
+                # st.write_stream sends incremental deltas and leaves the final text rendered without a cursor,
+                # so no separate final render is needed
+                cancel_placeholder = st.empty()
+                # Clicking Cancel reruns the script, which stops this run inside st.write_stream
+                cancel_placeholder.button("Cancel", key="cancel_generation")
+                received = []
+                token_stream = stream_chat_tokens(st.session_state.selected_model, full_context, received)
+                try:
+                    full_response = st.write_stream(token_stream)
+                except Exception:
+                    raise  # Ollama errors are reported below
+                except BaseException:
+                    # Run stopped or rerun (Cancel): keep the partial answer, or drop the unanswered prompt
+                    partial_response = "".join(received)
+                    if partial_response:
+                        st.session_state.messages.append({"role": "assistant", "content": partial_response})
+                        if sends_full_context:
+                            st.session_state.full_context_sent_for = st.session_state.file_hash
+                    else:
+                        st.session_state.messages.pop()
+                    logger.info("Generation cancelled (kept %d chars)", len(partial_response))
+                    raise
+                finally:
+                    token_stream.close()
+                cancel_placeholder.empty()
+                store_cached_response(cache_key, full_response)
 
         st.session_state.messages.append({
             "role": "assistant",
             "content": full_response
         })
+        if sends_full_context:
+            st.session_state.full_context_sent_for = st.session_state.file_hash
 
     except Exception as e:
         st.error(f"Error during chat with Ollama (Model: {st.session_state.selected_model}): {str(e)}")
         if st.session_state.messages and st.session_state.messages[-1]["role"] == "user":
             st.session_state.messages.pop()
-        print(f"--- Ollama Chat Exception: {type(e).__name__} - {e} ---")
+        logger.error("Ollama Chat Exception: %s - %s", type(e).__name__, e)